@@ -14,6 +14,7 @@ from surfa.io import protocol
 from surfa.io.utils import read_int
 from surfa.io.utils import write_int
 from surfa.io.utils import read_bytes
+from surfa.io.utils import read_array
 from surfa.io.utils import write_bytes
 from surfa.io.utils import check_file_readability
 
@@ -225,9 +226,10 @@ class MGHArrayIO(protocol.IOProtocol):
             # skip empty header space
             file.read(unused_header_space)
 
-            # read data buffer (MGH files store data in fortran order)
+            # read data buffer directly into a native-endian array (MGH files store
+            # data in fortran order, so the reshape doesn't copy)
             dtype = self.dtype_from_id(dtype_id)
-            data = read_bytes(file, dtype, int(np.prod(shape))).reshape(shape, order='F')
+            data = read_array(file, dtype, int(np.prod(shape))).reshape(shape, order='F')
 
             # init array
             arr = atype(data.squeeze())
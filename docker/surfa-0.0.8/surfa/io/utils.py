@@ -59,6 +59,44 @@ def write_int(file, value, size=4, signed=True, byteorder='big'):
     file.write(value.to_bytes(size, byteorder=byteorder, signed=signed))
 
 
+def read_array(file, dtype, count, chunk_size=1 << 20):
+    """
+    Read a binary array from a file buffer into a single preallocated, native-endian array.
+    Bytes are read in place with `readinto`, in chunks of `chunk_size` bytes so that
+    decompressing readers only allocate chunk-sized buffers, and non-native data is
+    byte-swapped in place.
+
+    Parameters
+    ----------
+    file : BufferedReader
+        Opened file buffer.
+    dtype : np.dtype
+        Numpy datatype of the stored data.
+    count : int
+        Number of elements to read.
+    chunk_size : int
+        Maximum number of bytes to read at once.
+
+    Returns
+    -------
+    np.ndarray:
+        The read array, in native byte order.
+    """
+    dtype = np.dtype(dtype)
+    buffer = np.empty(dtype.itemsize * count, dtype=np.uint8)
+    view = memoryview(buffer)
+    offset = 0
+    while offset < buffer.size:
+        nbytes = file.readinto(view[offset:offset + chunk_size])
+        if not nbytes:
+            raise EOFError(f'expected {buffer.size} bytes, but reached the end of the file after {offset}')
+        offset += nbytes
+    array = buffer.view(dtype)
+    if not array.dtype.isnative:
+        array = array.byteswap(inplace=True).view(array.dtype.newbyteorder('='))
+    return array
+
+
 def read_bytes(file, dtype, count=1):
     """
     Read from a binary file buffer.
@@ -78,7 +116,7 @@ def read_bytes(file, dtype, count=1):
         The read dtype array.
     """
     dtype = np.dtype(dtype)
-    value = np.fromstring(file.read(dtype.itemsize * count), dtype=dtype)
+    value = np.frombuffer(file.read(dtype.itemsize * count), dtype=dtype).copy()
     if count == 1:
         return value[0]
     return value
@@ -1,4 +1,10 @@
+from . import manifest
 from . import io
 from . import utils
 from . import ico
 from . import model
+from . import cache
+from . import checkpoint
+from . import preprocessing
+from . import inference
+from . import server
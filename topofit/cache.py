@@ -0,0 +1,110 @@
+import os
+import json
+import concurrent.futures
+import numpy as np
+import torch
+
+from . import io
+
+
+# cached arrays of each sample
+sample_arrays = ('input_image', 'input_vertices', 'true_vertices')
+
+
+def cache_filename(cachedir, hemi, name):
+    """
+    Path of a cache file for a hemisphere
+    """
+    return os.path.join(cachedir, f'{hemi}.{name}')
+
+
+def build_subject_cache(cachedir, subjs, hemi, jobs=1):
+    """
+    Decode the training samples of a list of subjects once and write them into memory-mappable
+    arrays (one .npy per array, with a row per subject) and a JSON index of subject rows. True
+    vertices are stored at full (ico-7) resolution, since the low-res training targets are
+    a subset of them. Subjects that fail to load are recorded in the index and skipped.
+    Returns the index dictionary.
+    """
+    os.makedirs(cachedir, exist_ok=True)
+    subjs = list(subjs)
+
+    def load(subj):
+        try:
+            data = io.load_subject_data(subj, hemi, ground_truth=True)
+        except Exception as error:
+            return subj, None, f'{type(error).__name__}: {error}'
+        return subj, data, None
+
+    arrays = {}
+    index = {'hemi': hemi, 'subjects': {}, 'failed': {}}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for row, (subj, data, error) in enumerate(executor.map(load, subjs)):
+            if data is None:
+                index['failed'][subj] = error
+                continue
+
+            # allocate the arrays from the shapes of the first sample. Arrays are written to
+            # temporary files, since a training run might be reading the current cache
+            for name in sample_arrays:
+                value = data[name].numpy()
+                if name not in arrays:
+                    filename = cache_filename(cachedir, hemi, f'{name}.npy.tmp')
+                    shape = (len(subjs), *value.shape)
+                    arrays[name] = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=shape)
+                arrays[name][row] = value
+
+            index['subjects'][subj] = row
+
+    # remove any previous index before replacing the arrays, so that the previous index
+    # is never read with the new arrays. Readers that already mapped arrays keep them
+    index_filename = cache_filename(cachedir, hemi, 'index.json')
+    if os.path.exists(index_filename):
+        os.remove(index_filename)
+    for name, array in arrays.items():
+        array.flush()
+        filename = cache_filename(cachedir, hemi, f'{name}.npy')
+        os.replace(filename + '.tmp', filename)
+
+    # write the index last (and atomically) so that an incomplete cache is never read
+    with open(index_filename + '.tmp', 'w') as file:
+        json.dump(index, file, indent=2)
+    os.replace(index_filename + '.tmp', index_filename)
+    return index
+
+
+class SubjectCache:
+    """
+    Read-only access to the memory-mapped training samples of a subject cache. Samples
+    are returned as tensor dictionaries matching `load_subject_data(..., ground_truth=True)`.
+    """
+
+    def __init__(self, cachedir, hemi):
+        with open(cache_filename(cachedir, hemi, 'index.json'), 'r') as file:
+            self.index = json.load(file)['subjects']
+        self.cachedir = cachedir
+        self.hemi = hemi
+        self.arrays = None
+
+    def __contains__(self, subj):
+        return subj in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def open(self):
+        """
+        Memory-map the cached arrays. This is done lazily, so that each data loader
+        worker maps the files itself instead of inheriting the maps
+        """
+        if self.arrays is None:
+            self.arrays = {name: np.load(cache_filename(self.cachedir, self.hemi, f'{name}.npy'), mmap_mode='r')
+                           for name in sample_arrays}
+        return self.arrays
+
+    def load(self, subj):
+        """
+        Load the cached sample of a subject
+        """
+        row = self.index[subj]
+        return {key: torch.from_numpy(np.array(array[row])) for key, array in self.open().items()}
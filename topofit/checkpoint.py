@@ -0,0 +1,118 @@
+import os
+import json
+import queue
+import threading
+import torch
+
+
+def snapshot(state):
+    """
+    Recursively copy the tensors of a (state dict) structure to CPU memory
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class CheckpointWriter:
+    """
+    Write training checkpoints in a background thread so that saving doesn't stall training.
+    Checkpoints are written atomically (to a temporary file that is renamed), and only the
+    last `keep_last` checkpoints are kept, along with the checkpoint of the best (lowest)
+    validation metric. The checkpoints of the run and the best one are tracked in a JSON
+    index next to the checkpoints, and only checkpoints of the run are ever removed. When
+    resuming a run after `resume_epoch`, its earlier checkpoints are read from the index.
+    """
+
+    def __init__(self, outdir, prefix, keep_last=3, resume_epoch=None):
+        self.outdir = outdir
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.index_file = os.path.join(outdir, f'{prefix}checkpoints.json')
+
+        self.epochs = []
+        self.best_epoch = None
+        self.best_metric = None
+        if resume_epoch is not None and os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as file:
+                index = json.load(file)
+            # checkpoints after the resumed epoch belong to an abandoned continuation of the run
+            self.epochs = [e for e in index.get('epochs', []) if e <= resume_epoch]
+            if index.get('best_epoch') is not None and index['best_epoch'] <= resume_epoch:
+                self.best_epoch = index['best_epoch']
+                self.best_metric = index['best_metric']
+
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def filename(self, epoch):
+        """
+        Path of the checkpoint of an epoch
+        """
+        return os.path.join(self.outdir, f'{self.prefix}{epoch:04d}.pt')
+
+    def save(self, epoch, state, metric=None):
+        """
+        Snapshot a checkpoint state (to CPU) and queue it to be written. A validation
+        `metric` marks the checkpoint as the best if it's the lowest so far
+        """
+        self.check()
+        self.queue.put((epoch, snapshot(state), metric))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None:
+                    self.write(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+            if item is None:
+                break
+
+    def write(self, epoch, state, metric):
+        filename = self.filename(epoch)
+        torch.save(state, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+        self.epochs = sorted(set(self.epochs) | {epoch})
+        if metric is not None and (self.best_metric is None or metric < self.best_metric):
+            self.best_epoch = epoch
+            self.best_metric = float(metric)
+
+        # remove old checkpoints of this run, except for the best one
+        candidates = [e for e in self.epochs if e not in (self.best_epoch, epoch)]
+        for old_epoch in candidates[:len(candidates) - max(self.keep_last - 1, 0)]:
+            if os.path.isfile(self.filename(old_epoch)):
+                os.remove(self.filename(old_epoch))
+            self.epochs.remove(old_epoch)
+
+        # update the checkpoint index
+        index = {'epochs': self.epochs, 'best_epoch': self.best_epoch, 'best_metric': self.best_metric}
+        with open(self.index_file + '.tmp', 'w') as file:
+            json.dump(index, file, indent=2)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def check(self):
+        """
+        Raise any error that occurred while writing
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('failed to write checkpoint') from error
+
+    def close(self):
+        """
+        Wait for all queued checkpoints to be written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
@@ -1,4 +1,6 @@
 import os
+import json
+import warnings
 import numpy as np
 import torch
 import surfa as sf
@@ -44,44 +46,346 @@ def get_initial_template(hemi):
     return surf.copy()
 
 
-def neighborhood(order):
+def neighborhood_filename(order, k=None):
     """
-    Retrieve the precomputed neighborhood mapping for icospheres
+    Path of the memory-mappable neighborhood store of an icosphere order, or of the generated
+    store with `k` neighbors. The store directory can be overridden with the
+    TOPOFIT_NEIGHBORHOODS environment variable
     """
-    filename = os.path.join(os.path.dirname(__file__), f'neighborhoods.npz')
+    default = os.path.join(os.path.dirname(__file__), 'neighborhoods')
+    name = f'ico-{order}.npy' if k is None else f'ico-{order}-k{k}.npy'
+    return os.path.join(os.environ.get('TOPOFIT_NEIGHBORHOODS', default), name)
+
+
+def neighborhood(order, k=None):
+    """
+    Retrieve the precomputed neighborhood mapping for icospheres as an int32 array of
+    shape [vertices, neighbors]. Neighbors are sorted by distance on the sphere, so
+    only the `k` nearest neighbors can be selected. The array is lazily memory-mapped
+    from the neighborhood store, which is converted from the downloaded npz file (or
+    generated if it's unavailable) on first use. If the store has fewer than `k`
+    neighbors, a separate store with `k` generated neighbors is used instead.
+    """
+    filename = neighborhood_filename(order)
+    if os.path.isfile(filename):
+        array = np.load(filename, mmap_mode='r')
+    elif os.path.isfile(downloaded_neighborhood_filename()):
+        array = loaded_mesh_data.get(f'neighborhood-{order}')
+        if array is None:
+            try:
+                array = np.load(write_neighborhood(order, downloaded_neighborhood(order)), mmap_mode='r')
+            except OSError:
+                # the store isn't writable, so keep the sorted neighborhoods in memory
+                array = sort_neighborhood(order, downloaded_neighborhood(order))
+                loaded_mesh_data[f'neighborhood-{order}'] = array
+    else:
+        array = generate_neighborhood(order, 1000 if k is None else k)
+
+    # generated neighborhoods differ from the downloaded ones, so they never replace the store
+    if k is not None and array.shape[1] < k:
+        filename = neighborhood_filename(order, k)
+        array = np.load(filename, mmap_mode='r') if os.path.isfile(filename) else generate_neighborhood(order, k, filename)
+
+    if k is not None:
+        array = array[:, :k]
+    return array
+
+
+def downloaded_neighborhood_filename():
+    return os.path.join(os.path.dirname(__file__), f'neighborhoods.npz')
+
+
+def downloaded_neighborhood(order):
+    """
+    Read an order of the downloaded neighborhood npz file (decompresses the full array)
+    """
+    filename = downloaded_neighborhood_filename()
     if not os.path.isfile(filename):
         raise RuntimeError(f'{filename} cannot be located - make sure it downloaded per instructions in the readme')
     npd = np.load(filename)
-    return npd[f'ico-{order}-1000'].astype(np.int64)
+    return npd[f'ico-{order}-1000']
+
+
+def sort_neighborhood(order, array, out=None, chunk_size=4096):
+    """
+    Sort the neighbors of each vertex by geodesic distance on the icosphere (in the same
+    order as generated neighborhoods), processing vertices in chunks. The result is
+    written into `out` if provided
+    """
+    coords = vertices(order).astype(np.float64)
+    coords /= np.linalg.norm(coords, axis=-1, keepdims=True)
+    if out is None:
+        out = np.empty(array.shape, dtype=np.int32)
+    for start in range(0, array.shape[0], chunk_size):
+        chunk = np.asarray(array[start:start + chunk_size])
+        distances = np.sum((coords[chunk] - coords[start:start + chunk.shape[0], None]) ** 2, axis=-1)
+        ordering = np.argsort(distances, axis=-1, kind='stable')
+        out[start:start + chunk.shape[0]] = np.take_along_axis(chunk, ordering, axis=-1)
+    return out
+
+
+def write_neighborhood(order, array, filename=None):
+    """
+    Write a neighborhood array to an uncompressed int32 store file that can be memory-mapped,
+    sorting neighbors by distance in the process
+    """
+    if filename is None:
+        filename = neighborhood_filename(order)
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmpfile = f'{filename}.{os.getpid()}.tmp.npy'
+    out = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=np.int32, shape=array.shape)
+    sort_neighborhood(order, array, out=out)
+    out.flush()
+    del out
+    os.replace(tmpfile, filename)
+    return filename
+
+
+def generate_neighborhood(order, k=1000, filename=None, chunk_size=8192):
+    """
+    Generate the `k` geodesic nearest neighbors of each icosphere vertex (including the
+    vertex itself) and cache them in the neighborhood store. On the sphere, the geodesic
+    ordering matches the euclidean ordering, so a KD-tree over the normalized vertices
+    returns neighbors sorted by geodesic distance.
+    """
+    from scipy.spatial import cKDTree
+
+    if filename is None:
+        filename = neighborhood_filename(order)
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+    coords = vertices(order).astype(np.float64)
+    coords /= np.linalg.norm(coords, axis=-1, keepdims=True)
+    tree = cKDTree(coords)
+
+    tmpfile = f'{filename}.{os.getpid()}.tmp.npy'
+    out = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=np.int32, shape=(coords.shape[0], k))
+    for start in range(0, coords.shape[0], chunk_size):
+        _, indices = tree.query(coords[start:start + chunk_size], k=k, workers=-1)
+        out[start:start + indices.shape[0]] = indices
+    out.flush()
+    del out
+    os.replace(tmpfile, filename)
+    return np.load(filename, mmap_mode='r')
+
+
+def neighborhood_overlap(order, a, b, chunk_size=4096):
+    """
+    Compute the fraction of shared neighbors between two neighborhood arrays of an
+    icosphere order, for each vertex, considering the first K neighbors of both. Neighbors
+    that are as close as the K-th neighbor of the other array count as shared, since
+    equidistant neighbors can be ordered either way
+    """
+    k = min(a.shape[1], b.shape[1])
+    coords = vertices(order).astype(np.float64)
+    coords /= np.linalg.norm(coords, axis=-1, keepdims=True)
+    overlap = np.empty(a.shape[0], dtype=np.float32)
+    for start in range(0, a.shape[0], chunk_size):
+        centers = coords[start:start + chunk_size, None]
+        distances_a = np.sum((coords[np.asarray(a[start:start + chunk_size, :k])] - centers) ** 2, axis=-1)
+        distances_b = np.sum((coords[np.asarray(b[start:start + chunk_size, :k])] - centers) ** 2, axis=-1)
+        # tolerate rounding differences between equidistant neighbors
+        shared_a = distances_a <= distances_b.max(-1, keepdims=True) * (1 + 1e-6)
+        shared_b = distances_b <= distances_a.max(-1, keepdims=True) * (1 + 1e-6)
+        overlap[start:start + centers.shape[0]] = np.minimum(shared_a.mean(-1), shared_b.mean(-1))
+    return overlap
 
 
 def load_topology(order):
     """
-    Load mesh topology information for a specific icosphere order
+    Load mesh topology information for a specific icosphere order. Arrays are
+    memory-mapped from the precompiled topology bundle if it has been built
     """
+    arrays = bundled_topology_arrays(order)
+    if arrays is None:
+        arrays = topology_arrays(order)
+
     device = utils.get_device()
+    def tensor(key):
+        # bundled arrays are read-only views of shared pages, which torch warns about
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(arrays[key]).to(device)
+
+    def scalar(key):
+        # bundles built before scalars were stored 0-d hold them with shape (1,)
+        return arrays[key].reshape(())[()]
+
     topology = {
         'order': order,
-        'size': nvertices(order),
-        'faces': torch.from_numpy(faces(order).astype(np.int64, copy=False)).to(device),
-        'adj_edges_a': torch.from_numpy(adjancency_indices(order)[:, 0].astype(np.int64, copy=False)).to(device),
-        'adj_edges_b': torch.from_numpy(adjancency_indices(order)[:, 1].astype(np.int64, copy=False)).to(device),
-        'adj_weights': torch.from_numpy(adjancency_weights(order).astype(np.float32, copy=False)).to(device),
+        'size': int(scalar('size')),
+        'faces': tensor('faces'),
+        'adj_edges_a': tensor('adj_edges_a'),
+        'adj_edges_b': tensor('adj_edges_b'),
+        'adj_weights': tensor('adj_weights'),
         'upsampler': [
-            torch.from_numpy(upsampling_sources(order).astype(np.int64, copy=False)).to(device),
-            torch.from_numpy(upsampling_weights(order).astype(np.float32, copy=False)).to(device),
+            tensor('upsampler_sources'),
+            tensor('upsampler_weights'),
         ],
-        'pooling_a': torch.from_numpy(pooling_sources(order)[:, 0].astype(np.int64, copy=False)).to(device),
-        'pooling_b': torch.from_numpy(pooling_sources(order)[:, 1].astype(np.int64, copy=False)).to(device),
-        'pooling_weights': torch.from_numpy(pooling_weights(order).astype(np.float32, copy=False)).to(device),
-        'pooling_shape_a': pooling_shapes(order)[0].astype(np.int64, copy=False),
-        'pooling_shape_b': pooling_shapes(order)[1].astype(np.int64, copy=False),
+        'pooling_a': tensor('pooling_a'),
+        'pooling_b': tensor('pooling_b'),
+        'pooling_weights': tensor('pooling_weights'),
+        'pooling_shape_a': scalar('pooling_shape_a'),
+        'pooling_shape_b': scalar('pooling_shape_b'),
+        'pooling_table_a': tensor('pooling_table_a'),
+        'pooling_empty_a': tensor('pooling_empty_a') if 'pooling_empty_a' in arrays else None,
+        'pooling_table_b': tensor('pooling_table_b'),
+        'pooling_empty_b': tensor('pooling_empty_b') if 'pooling_empty_b' in arrays else None,
     }
-    if order in (6, 7):
-        topology['edge_faces'] = torch.from_numpy(edge_faces(order).astype(np.int64, copy=False)).to(device)
+    if 'edge_faces' in arrays:
+        topology['edge_faces'] = tensor('edge_faces')
     return topology
 
 
+def topology_arrays(order):
+    """
+    Compute the numpy arrays of a topology from the icosphere npz file, in the
+    datatypes consumed by the model
+    """
+    adjacency = adjancency_indices(order).astype(np.int64, copy=False)
+    pooling = pooling_sources(order).astype(np.int64, copy=False)
+    shape_a, shape_b = pooling_shapes(order).astype(np.int64, copy=False)
+    arrays = {
+        'size': np.asarray(nvertices(order), dtype=np.int64),
+        'faces': faces(order).astype(np.int64),
+        'adj_edges_a': np.ascontiguousarray(adjacency[:, 0]),
+        'adj_edges_b': np.ascontiguousarray(adjacency[:, 1]),
+        'adj_weights': adjancency_weights(order).astype(np.float32, copy=False),
+        'upsampler_sources': upsampling_sources(order).astype(np.int64),
+        'upsampler_weights': upsampling_weights(order).astype(np.float32),
+        'pooling_a': np.ascontiguousarray(pooling[:, 0]),
+        'pooling_b': np.ascontiguousarray(pooling[:, 1]),
+        'pooling_weights': pooling_weights(order).astype(np.float32, copy=False),
+        'pooling_shape_a': np.asarray(shape_a),
+        'pooling_shape_b': np.asarray(shape_b),
+    }
+    for suffix, sources, targets, size in (('a', pooling[:, 1], pooling[:, 0], shape_a),
+                                           ('b', pooling[:, 0], pooling[:, 1], shape_b)):
+        table, empty = fanin_tables(sources, targets, int(size))
+        arrays[f'pooling_table_{suffix}'] = table
+        if empty is not None:
+            arrays[f'pooling_empty_{suffix}'] = empty
+    if order in (6, 7):
+        arrays['edge_faces'] = edge_faces(order).astype(np.int64, copy=False)
+    return arrays
+
+
+def fanin_tables(sources, targets, size):
+    """
+    Convert (source, target) index pairs into a fixed fan-in table of shape [size, K]
+    listing the sources of each target vertex. Rows with fewer than K sources are padded
+    by repeating their first source, which does not change a max-reduction. Also returns
+    a mask of targets without any sources, or None if every target has a source.
+    """
+    order = np.argsort(targets, kind='stable')
+    sources = sources[order]
+    targets = targets[order]
+
+    counts = np.bincount(targets, minlength=size)
+    ranks = np.arange(len(targets)) - (np.cumsum(counts) - counts)[targets]
+
+    table = np.zeros((size, max(counts.max(), 1)), dtype=np.int64)
+    filled = np.zeros(table.shape, dtype=bool)
+    table[targets, ranks] = sources
+    filled[targets, ranks] = True
+    table = np.where(filled, table, table[:, :1])
+
+    empty = counts == 0
+    return table, (empty if empty.any() else None)
+
+
+# topology bundle layout: magic, little-endian uint64 header size, JSON header, and
+# aligned raw array data (header offsets are relative to the start of the data)
+bundle_magic = b'TOPOBNDL'
+bundle_alignment = 64
+
+
+def bundle_filename():
+    """
+    Path of the precompiled topology bundle, which can be overridden with
+    the TOPOFIT_TOPOLOGY_BUNDLE environment variable
+    """
+    default = os.path.join(os.path.dirname(__file__), 'topology.bundle')
+    return os.environ.get('TOPOFIT_TOPOLOGY_BUNDLE', default)
+
+
+def align(offset):
+    return -(-offset // bundle_alignment) * bundle_alignment
+
+
+def build_topology_bundle(filename=None, orders=range(1, 8)):
+    """
+    Precompile the topology arrays of a set of icosphere orders into a single
+    uncompressed, aligned binary file that can be memory-mapped by load_topology
+    """
+    if filename is None:
+        filename = bundle_filename()
+
+    entries = {}
+    arrays = []
+    offset = 0
+    for order in orders:
+        for key, array in topology_arrays(order).items():
+            # keep scalars 0-d (ascontiguousarray would make them 1-d), tobytes writes C order
+            array = np.asarray(array)
+            offset = align(offset)
+            entries[f'{order}/{key}'] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            arrays.append((offset, array))
+            offset += array.nbytes
+
+    header = json.dumps(entries).encode('utf-8')
+    data_start = align(len(bundle_magic) + 8 + len(header))
+
+    # write to a temporary file first so that readers never map a partial bundle
+    tmpfile = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpfile, 'wb') as file:
+        file.write(bundle_magic)
+        file.write(len(header).to_bytes(8, 'little'))
+        file.write(header)
+        for offset, array in arrays:
+            file.seek(data_start + offset)
+            file.write(array.tobytes())
+    os.replace(tmpfile, filename)
+
+    # drop any previously mapped bundle
+    loaded_mesh_data.pop('bundle', None)
+    return filename
+
+
+def topology_bundle():
+    """
+    Memory-map the topology bundle, returning a dictionary of read-only arrays keyed
+    by `order/name`, or an empty dictionary if no bundle has been built
+    """
+    bundle = loaded_mesh_data.get('bundle')
+    if bundle is None:
+        bundle = {}
+        filename = bundle_filename()
+        if os.path.isfile(filename):
+            buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+            if bytes(buffer[:len(bundle_magic)]) != bundle_magic:
+                raise RuntimeError(f'{filename} is not a valid topology bundle')
+            header_start = len(bundle_magic) + 8
+            header_size = int.from_bytes(bytes(buffer[len(bundle_magic):header_start]), 'little')
+            entries = json.loads(bytes(buffer[header_start:header_start + header_size]).decode('utf-8'))
+            data_start = align(header_start + header_size)
+            for key, entry in entries.items():
+                bundle[key] = np.ndarray(entry['shape'], dtype=np.dtype(entry['dtype']),
+                                         buffer=buffer, offset=data_start + entry['offset'])
+        loaded_mesh_data['bundle'] = bundle
+    return bundle
+
+
+def bundled_topology_arrays(order):
+    """
+    Retrieve the memory-mapped arrays of a topology order, or None if the order
+    is not bundled
+    """
+    prefix = f'{order}/'
+    arrays = {k[len(prefix):]: v for k, v in topology_bundle().items() if k.startswith(prefix)}
+    return arrays if arrays else None
+
+
 def faces(order):
     return get_ico_data(f'ico-{order}-faces')
 
@@ -0,0 +1,171 @@
+import os
+import time
+import queue
+import threading
+import concurrent.futures
+import numpy as np
+import surfa as sf
+import torch
+
+from . import io
+from . import utils
+from . import manifest
+from .model import SurfNet
+
+
+def load_model(filename, config=None):
+    """
+    Configure a SurfNet with trained weights in evaluation mode
+    """
+    device = utils.get_device()
+    model = SurfNet(config).to(device)
+    weights = torch.load(filename, map_location=device)
+    model.load_state_dict(weights['model_state_dict'])
+    model.train(mode=False)
+    return model
+
+
+def predict_vertices(model, batch_data):
+    """
+    Predict the surface vertices of a list of subject data dictionaries in a single
+    forward pass. Returns a list of vertex arrays and the shared mesh faces
+    """
+    device = utils.get_device()
+    with torch.no_grad():
+        input_image = torch.stack([data['input_image'] for data in batch_data]).to(device)
+        input_vertices = torch.stack([data['input_vertices'] for data in batch_data]).to(device)
+        result, topology = model(input_image, input_vertices)
+        batch_vertices = result['pred_vertices'].cpu().numpy()
+        faces = topology['faces'].cpu().numpy()
+    return list(batch_vertices), faces
+
+
+def build_surface(vertices, faces, data):
+    """
+    Build a predicted mesh and convert it to the geometry of the input image
+    """
+    surf = sf.Mesh(vertices, faces, space='vox', geometry=data['cropped_geometry'])
+    return surf.convert(geometry=data['input_geometry'])
+
+
+def surface_filename(subj, hemi, suffix='topofit', outdir=None):
+    """
+    Get the output path of a predicted surface. Surfaces are written to the subject's
+    surf directory unless it is not writable or an output directory is specified
+    """
+    if os.access(os.path.join(subj, 'surf'), os.W_OK) and outdir is None:
+        return os.path.join(subj, 'surf', f'{hemi}.white.{suffix}')
+    id = subj.split('/')[-1]
+    return f'{outdir}/{id}.{hemi}.white.{suffix}'
+
+
+class StageTimes:
+    """
+    Thread-safe accumulation of busy and stall times for each pipeline stage
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, kind, seconds):
+        with self.lock:
+            stage_times = self.times.setdefault(stage, {'busy': 0.0, 'stalled': 0.0})
+            stage_times[kind] += seconds
+
+    def summary(self):
+        lines = [f'{"stage":<10}{"busy (sec)":>12}{"stalled (sec)":>15}']
+        for stage, stage_times in self.times.items():
+            lines.append(f'{stage:<10}{stage_times["busy"]:>12.2f}{stage_times["stalled"]:>15.2f}')
+        return '\n'.join(lines)
+
+
+def run_pipeline(subjs, models, batch_size=1, prefetch=2, loaders=1, writers=2, suffix='topofit', outdir=None,
+                 subject_manifest=None):
+    """
+    Evaluate subjects with models keyed by hemisphere, overlapping subject loading,
+    prediction and surface writing. Loader threads fill a bounded queue of decoded
+    subjects, the calling thread runs the models, and a pool of writer threads converts
+    and saves surfaces. Returns the busy and stall times of each stage: a stalled loader
+    is waiting for queue space, a stalled predict stage is waiting for data or writers,
+    and a stalled writer is idle waiting for surfaces to write. Subject paths are taken
+    from an optional `SubjectManifest`.
+    """
+    pipeline_start = time.perf_counter()
+    hemis = tuple(models.keys())
+    batches = [subjs[i:i + batch_size] for i in range(0, len(subjs), batch_size)]
+    batch_queue = queue.Queue(maxsize=max(prefetch, 1))
+    write_slots = threading.Semaphore(max(writers, 1) * 2)
+    times = StageTimes()
+    done = object()
+
+    def load(batch_indices):
+        try:
+            for index in batch_indices:
+                start = time.perf_counter()
+                entries = [manifest.subject_entry(subj, subject_manifest, manifest.loading_keys()) for subj in batches[index]]
+                batch_data = [io.load_subject_hemis(subj, hemis, entry=entry) for subj, entry in zip(batches[index], entries)]
+                loaded = time.perf_counter()
+                batch_queue.put((batches[index], batch_data))
+                times.add('load', 'busy', loaded - start)
+                times.add('load', 'stalled', time.perf_counter() - loaded)
+        except Exception as error:
+            batch_queue.put(error)
+        finally:
+            batch_queue.put(done)
+
+    def write(vertices, faces, data, filename):
+        try:
+            start = time.perf_counter()
+            surf = build_surface(vertices, faces, data)
+            surf.save(filename)
+            times.add('write', 'busy', time.perf_counter() - start)
+            print(f'Saved white-matter surface to {filename}', flush=True)
+        finally:
+            write_slots.release()
+
+    # distribute batches across loader threads
+    loaders = max(min(loaders, len(batches)), 1)
+    loader_threads = [threading.Thread(target=load, args=(range(n, len(batches), loaders),), daemon=True) for n in range(loaders)]
+    for thread in loader_threads:
+        thread.start()
+
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(writers, 1)) as executor:
+        finished_loaders = 0
+        while finished_loaders < loaders:
+
+            # wait for decoded subjects
+            start = time.perf_counter()
+            item = batch_queue.get()
+            times.add('predict', 'stalled', time.perf_counter() - start)
+            if item is done:
+                finished_loaders += 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+
+            batch_subjs, batch_data = item
+            for hemi in hemis:
+                hemi_data = [data[hemi] for data in batch_data]
+
+                start = time.perf_counter()
+                batch_vertices, faces = predict_vertices(models[hemi], hemi_data)
+                times.add('predict', 'busy', time.perf_counter() - start)
+
+                # hand off to the writer pool, waiting if the writers fall behind
+                for subj, data, vertices in zip(batch_subjs, hemi_data, batch_vertices):
+                    start = time.perf_counter()
+                    write_slots.acquire()
+                    times.add('predict', 'stalled', time.perf_counter() - start)
+                    filename = surface_filename(subj, hemi, suffix, outdir)
+                    futures.append(executor.submit(write, vertices, faces, data, filename))
+
+    # surface any writer errors
+    for future in futures:
+        future.result()
+
+    # writers are idle whenever they are not busy
+    elapsed = time.perf_counter() - pipeline_start
+    times.add('write', 'stalled', max(writers, 1) * elapsed - times.times.get('write', {}).get('busy', 0.0))
+    return times
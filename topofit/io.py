@@ -1,3 +1,5 @@
+import gzip
+import struct
 import itertools
 import numpy as np
 import surfa as sf
@@ -5,31 +7,154 @@ import torch
 import os
 from . import ico
 from . import utils
+from . import manifest
 
 
 # image shape used during training
 target_image_shape = (96, 144, 192)
 
 
-def load_subject_data(subj, hemi, ground_truth=False, low_res=False): 
+# geometry of the MNI305 average (mni305.cor.mgz) targeted by talairach transforms
+mni305_geometry = dict(shape=(256, 256, 256), voxsize=(1, 1, 1),
+                       rotation=((-1, 0, 0), (0, 0, 1), (0, -1, 0)), center=(0, 0, 0))
+
+
+# numpy datatypes of MGH datatype IDs
+mgh_dtypes = {0: '>u1', 1: '>i4', 2: '>i8', 3: '>f4', 4: '>i2', 6: '>f4', 10: '>u2'}
+
+
+def read_mgh_header(file):
     """
-    Load a FreeSurfer subject image and surface. Use the talairach alignment
-    to place the initial template surface and crop the image.
+    Read the header of an opened MGH file, leaving the file at the start of the voxel data.
+    Returns the data shape, datatype, and geometry parameters (empty if the geometry is
+    flagged as invalid)
+    """
+    header = file.read(284)
+    shape = struct.unpack('>4i', header[4:20])
+    dtype_id = struct.unpack('>i', header[20:24])[0]
+    if dtype_id not in mgh_dtypes:
+        raise NotImplementedError(f'unsupported MGH data type ID: {dtype_id}')
+    geom_params = {}
+    if struct.unpack('>h', header[28:30])[0]:
+        params = np.asarray(struct.unpack('>15f', header[30:90]), dtype=np.float64)
+        geom_params = dict(voxsize=params[:3], rotation=params[3:12].reshape((3, 3), order='F'), center=params[12:])
+    return shape, np.dtype(mgh_dtypes[dtype_id]), geom_params
+
+
+def read_array(file, dtype, count, chunk_size=1 << 20):
+    """
+    Read a binary array from an opened file into a single preallocated, native-endian array.
+    Bytes are read in place with `readinto`, in chunks so that decompressing readers only
+    allocate chunk-sized buffers, and non-native data is byte-swapped in place once
+    """
+    dtype = np.dtype(dtype)
+    buffer = np.empty(dtype.itemsize * count, dtype=np.uint8)
+    view = memoryview(buffer)
+    offset = 0
+    while offset < buffer.size:
+        nbytes = file.readinto(view[offset:offset + chunk_size])
+        if not nbytes:
+            raise EOFError(f'expected {buffer.size} bytes, but reached the end of the file after {offset}')
+        offset += nbytes
+    array = buffer.view(dtype)
+    if not array.dtype.isnative:
+        array = array.byteswap(inplace=True).view(array.dtype.newbyteorder('='))
+    return array
+
+
+def load_volume(filename):
+    """
+    Load an MGH/MGZ volume, decoding the voxel data in place into a native-endian array.
+    Unlike `sf.load_volume`, scan parameters and metadata tags are not read
+    """
+    fopen = gzip.open if filename.lower().endswith('gz') else open
+    with fopen(filename, 'rb') as file:
+        shape, dtype, geom_params = read_mgh_header(file)
+        data = read_array(file, dtype, int(np.prod(shape))).reshape(shape, order='F')
+    volume = sf.Volume(data.squeeze())
+    volume.geom.update(**geom_params)
+    return volume
+
+
+def load_image_geometry(filename):
+    """
+    Load the image geometry of an MGH/MGZ file by reading only its header
+    """
+    fopen = gzip.open if filename.lower().endswith('gz') else open
+    with fopen(filename, 'rb') as file:
+        shape, _, geom_params = read_mgh_header(file)
+    return sf.ImageGeometry(shape[:3], **geom_params)
+
+
+def load_mni_xfm(filename):
+    """
+    Load the RAS-to-RAS matrix of a linear MNI transform (.xfm) file
+    """
+    with open(filename, 'r') as file:
+        content = file.read()
+    values = content.split('Linear_Transform', 1)[1].split('=', 1)[1].split(';', 1)[0].split()
+    matrix = np.eye(4)
+    matrix[:3] = np.asarray(values, dtype=np.float64).reshape((3, 4))
+    return matrix
+
+
+def talairach_xfm_to_lta(subj, output=None, target=None):
+    """
+    Convert the talairach.xfm of a subject into a vox2vox affine between orig.mgz and
+    the MNI305 average, matching `lta_convert --ltavox2vox`. The target geometry is read
+    from `target` (by default $FREESURFER_HOME/average/mni305.cor.mgz if available). The
+    affine is saved as an LTA if `output` is provided.
+    """
+    if target is None and os.environ.get('FREESURFER_HOME') is not None:
+        target = os.path.join(os.environ['FREESURFER_HOME'], 'average', 'mni305.cor.mgz')
+    if target is not None and os.path.isfile(target):
+        target_geom = load_image_geometry(target)
+    else:
+        target_geom = sf.ImageGeometry(**mni305_geometry)
+
+    source_geom = load_image_geometry(f'{subj}/mri/orig.mgz')
+    ras2ras = load_mni_xfm(f'{subj}/mri/transforms/talairach.xfm')
+    vox2vox = target_geom.world2vox.matrix @ ras2ras @ source_geom.vox2world.matrix
+
+    affine = sf.Affine(vox2vox, source=source_geom, target=target_geom, space='vox')
+    if output is not None:
+        affine.save(output)
+    return affine
+
+
+def load_subject_image(subj, entry=None):
     """
+    Load a FreeSurfer subject image and its talairach alignment, which can
+    be shared across the preprocessing of both hemispheres. Paths are taken
+    from a subject manifest `entry` if provided.
+    """
+    if entry is None:
+        entry = manifest.resolve_subject(subj, keys=manifest.loading_keys())
 
     # load bias corrected image and talairach affine
-    image = sf.load_volume(f'{subj}/mri/norm.mgz')
-    #try:
-    
-    id = subj.split('/')[-1]
-    if os.path.isdir('ltafiles') and os.path.exists(f'ltafiles/{id}.talairach.xfm.lta'):
-        affine = sf.load_affine(f'ltafiles/{id}.talairach.xfm.lta').inv().convert(space='vox', target=image)
+    image = load_volume(entry['paths']['norm'])
+    if entry['mtimes']['lta'] is not None:
+        affine = sf.load_affine(entry['paths']['lta'])
     else:
-        affine = sf.load_affine(f'{subj}/mri/transforms/talairach.xfm.lta').inv().convert(space='vox', target=image)
-    #except:
-    #    print('fix 1: ensure exists: {subj}/mri/transforms/talairach.xfm.lta')
-    #    print('fix 2: create ltafiles folder in basedirectory and run preprocess to create those files with rod flag')
-    #    raise
+        # convert the talairach.xfm directly when no LTA has been preprocessed
+        affine = talairach_xfm_to_lta(subj)
+    affine = affine.inv().convert(space='vox', target=image)
+    return image, affine
+
+
+def load_subject_data(subj, hemi, ground_truth=False, low_res=False, subject_image=None, entry=None):
+    """
+    Load a FreeSurfer subject image and surface. Use the talairach alignment
+    to place the initial template surface and crop the image. A previously
+    loaded (image, affine) pair can be provided with `subject_image`, and
+    paths are taken from a subject manifest `entry` if provided.
+    """
+    if entry is None:
+        entry = manifest.resolve_subject(subj, keys=manifest.loading_keys([hemi], ground_truth))
+    if subject_image is None:
+        subject_image = load_subject_image(subj, entry)
+    image, affine = subject_image
+
     # load the initial template surface and align to subject
     template = ico.get_initial_template(hemi)
     template.vertices = affine.transform(template.vertices)
@@ -56,16 +181,7 @@ def load_subject_data(subj, hemi, ground_truth=False, low_res=False):
 
     # ground-truths might be needed (for training)
     if ground_truth:
-        #try:
-        id = subj.split('/')[-1]
-        if os.path.isdir('whiteicosurf') and os.path.exists(f'whiteicosurf/{id}.{hemi}.white.ico.surf'):#path for read only access to data
-            true_vertices = sf.load_mesh(f'whiteicosurf/{id}.{hemi}.white.ico.surf')
-        else:
-            true_vertices = sf.load_mesh(f'{subj}/surf/{hemi}.white.ico.surf')
-        #except:
-        #    print('fix 1: ensure exists: {subj}/mri/transforms/talairach.xfm.lta')
-        #    print('fix 2: create whiteicosurf folder in basedirectory and run preprocess to create those files with rod flag')
-        #raise        
+        true_vertices = sf.load_mesh(entry['paths'][f'{hemi}.white.ico'])
         true_vertices = true_vertices.convert(space='vox', geometry=cropped_image).vertices.astype(np.float32)
         if low_res:
             true_vertices = true_vertices[ico.get_mapping(7, 6)]
@@ -74,6 +190,17 @@ def load_subject_data(subj, hemi, ground_truth=False, low_res=False):
     return data
 
 
+def load_subject_hemis(subj, hemis, ground_truth=False, low_res=False, entry=None):
+    """
+    Load the data of multiple hemispheres of a subject, decoding the image and
+    talairach alignment only once. Returns a dictionary keyed by hemisphere.
+    """
+    if entry is None:
+        entry = manifest.resolve_subject(subj, keys=manifest.loading_keys(hemis, ground_truth))
+    subject_image = load_subject_image(subj, entry)
+    return {hemi: load_subject_data(subj, hemi, ground_truth, low_res, subject_image, entry) for hemi in hemis}
+
+
 def compute_image_cropping(image_shape, vertices):
     """
     Compute the correct image cropping given the bounding box of aligned vertices
@@ -100,23 +227,79 @@ def compute_image_cropping(image_shape, vertices):
 
 class InfiniteSampler(torch.utils.data.IterableDataset):
     """
-    Iterable torch dataset that infinitively samples training subjects.
+    Iterable torch dataset that infinitively samples training subjects at full
+    resolution (the model subsets the targets during low-res training). Subjects
+    found in an optional `SubjectCache` are read from the cache instead of decoded.
+
+    With `random` sampling, each step draws a subject with replacement. With `epoch`
+    sampling, subjects are drawn without replacement from a shuffle of the list that
+    is shared by all data loader workers, and each worker loads its own part of it.
+    Every worker uses its own random generator, derived from `seed` and its worker id
+    (a random seed is chosen if none is given). Subject paths are taken from an optional
+    `SubjectManifest`.
+
+    To resume a sampled sequence, `skip_batches` batches (of `batch_size` samples) that
+    were already consumed are skipped without loading them. The data loader collects
+    batches from its workers in turn, starting with the first worker, so when resuming,
+    each worker takes over the sequence of the worker whose batch comes next.
     """
-    def __init__(self, hemi, training_subjs, low_res):
+    def __init__(self, hemi, training_subjs, cache=None, sampling='random', skip_batches=0, batch_size=1,
+                 subject_manifest=None, seed=None):
         super().__init__()
+        if sampling not in ('random', 'epoch'):
+            raise ValueError(f'unknown sampling mode `{sampling}`.')
         self.hemi = hemi
         self.training_subjs = training_subjs
-        self.low_res = low_res
+        self.cache = cache
+        self.sampling = sampling
+        self.skip_batches = skip_batches
+        self.batch_size = batch_size
+        self.subject_manifest = subject_manifest
+        self.seed = int(np.random.SeedSequence().entropy % 2 ** 31) if seed is None else seed
 
     def __iter__(self):
         yield from itertools.islice(self.infinite(), 0, None, 1)
 
+    def worker_position(self):
+        """
+        Return the (worker id, number of workers) of the current process. The worker id
+        is the position of the worker in the sampled sequence, which is offset by the
+        skipped batches. Outside of a worker, the process samples the whole sequence
+        """
+        info = torch.utils.data.get_worker_info()
+        if info is None:
+            return 0, 1
+        return (info.id + self.skip_batches) % info.num_workers, info.num_workers
+
+    def indices(self):
+        """
+        Generate the infinite sequence of subject indices sampled by this worker
+        """
+        worker_id, num_workers = self.worker_position()
+        if self.sampling == 'random':
+            rng = np.random.default_rng([self.seed, worker_id])
+            while True:
+                yield rng.integers(len(self.training_subjs))
+        else:
+            for epoch in itertools.count():
+                order = np.random.default_rng([self.seed, epoch]).permutation(len(self.training_subjs))
+                yield from order[worker_id::num_workers]
+
     def infinite(self):
-        while True:
-            idx = np.random.randint(len(self.training_subjs))
+        indices = self.indices()
+        if self.skip_batches > 0:
+            # batches are collected from the workers in turn
+            worker_id, num_workers = self.worker_position()
+            consumed = len(range(worker_id, self.skip_batches, num_workers)) * self.batch_size
+            indices = itertools.islice(indices, consumed, None)
+        for idx in indices:
             subj = self.training_subjs[idx]
+            if self.cache is not None and subj in self.cache:
+                yield self.cache.load(subj)
+                continue
             try:
-                data = load_subject_data(subj, self.hemi, ground_truth=True, low_res=self.low_res)
+                entry = manifest.subject_entry(subj, self.subject_manifest, manifest.loading_keys([self.hemi], True))
+                data = load_subject_data(subj, self.hemi, ground_truth=True, entry=entry)
                 data = {k: v for k, v in data.items() if k in ('input_image', 'input_vertices', 'true_vertices')}
             except RuntimeError:
                 continue
@@ -124,9 +307,12 @@ class InfiniteSampler(torch.utils.data.IterableDataset):
 
 
 class Collator:
+    """
+    Stack a list of samples into a batch of tensors
+    """
 
     def __init__(self, data):
-        self.data = data[0]
+        self.data = {key: torch.stack([sample[key] for sample in data]) for key in data[0]}
 
     def pin_memory(self):
         for key, value in self.data.items():
@@ -134,9 +320,16 @@ class Collator:
         return self
 
 
-def get_data_loader(hemi, training_subjs, low_res=False, prefetch_factor=8):
+def get_data_loader(hemi, training_subjs, prefetch_factor=8, cache=None,
+                    num_workers=1, sampling='random', seed=None, batch_size=1, skip_batches=0, subject_manifest=None):
+    """
+    Configure a training data loader with `num_workers` loading processes. Providing
+    a `seed` makes the sampled subject sequence reproducible, and `skip_batches`
+    resumes the sequence after that many batches
+    """
     collate_fn = lambda batch : Collator(batch)
-    sampler = InfiniteSampler(hemi, training_subjs, low_res)
-    data_loader = torch.utils.data.DataLoader(sampler, batch_size=1, num_workers=1,
-        prefetch_factor=prefetch_factor, collate_fn=collate_fn, pin_memory=True)
+    sampler = InfiniteSampler(hemi, training_subjs, cache, sampling, skip_batches, batch_size, subject_manifest, seed)
+    kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+    data_loader = torch.utils.data.DataLoader(sampler, batch_size=batch_size, num_workers=num_workers,
+        collate_fn=collate_fn, pin_memory=True, **kwargs)
     return data_loader
@@ -0,0 +1,162 @@
+import os
+import json
+import concurrent.futures
+
+
+def subject_id(subj):
+    """
+    Subject ID derived from the subject path
+    """
+    return subj.rstrip('/').split('/')[-1]
+
+
+def candidate_paths(subj, workdir=None):
+    """
+    Candidate paths of each subject file, in order of preference. Preprocessed outputs of
+    read-only subjects (in the ltafiles and whiteicosurf directories of `workdir`, by
+    default the current working directory) take precedence over the subject directory
+    """
+    id = subject_id(subj)
+    workdir = os.getcwd() if workdir is None else workdir
+    candidates = {
+        'norm': [f'{subj}/mri/norm.mgz'],
+        'orig': [f'{subj}/mri/orig.mgz'],
+        'xfm': [f'{subj}/mri/transforms/talairach.xfm'],
+        'lta': [f'{workdir}/ltafiles/{id}.talairach.xfm.lta', f'{subj}/mri/transforms/talairach.xfm.lta'],
+    }
+    for hemi in ('lh', 'rh'):
+        candidates[f'{hemi}.white'] = [f'{subj}/surf/{hemi}.white']
+        candidates[f'{hemi}.sphere.reg'] = [f'{subj}/surf/{hemi}.sphere.reg']
+        candidates[f'{hemi}.white.ico'] = [f'{workdir}/whiteicosurf/{id}.{hemi}.white.ico.surf', f'{subj}/surf/{hemi}.white.ico.surf']
+    return candidates
+
+
+def loading_keys(hemis=(), ground_truth=False):
+    """
+    Keys of the subject files needed to load the data of hemispheres
+    """
+    keys = ['norm', 'lta']
+    if ground_truth:
+        keys += [f'{hemi}.white.ico' for hemi in hemis]
+    return keys
+
+
+def resolve_subject(subj, workdir=None, keys=None):
+    """
+    Resolve the paths of the files of a subject with a single stat call per candidate,
+    optionally only for a subset of file `keys`. Returns an entry with the resolved `paths`
+    and their modification `mtimes`. Missing files resolve to their last candidate with a
+    modification time of None
+    """
+    candidates = candidate_paths(subj, workdir)
+    entry = {'paths': {}, 'mtimes': {}}
+    for key in candidates if keys is None else keys:
+        for path in candidates[key]:
+            try:
+                mtime = os.stat(path).st_mtime
+                break
+            except FileNotFoundError:
+                mtime = None
+        entry['paths'][key] = path
+        entry['mtimes'][key] = mtime
+    return entry
+
+
+class SubjectManifest:
+    """
+    Index of the resolved file paths and modification times of a list of subjects. The
+    manifest is built once (stat-ing subjects in parallel) and can be saved as JSON, so
+    that loading and preprocessing subjects doesn't probe the filesystem for every file.
+    Read-only and writable subject layouts are resolved the same way
+    """
+
+    def __init__(self, subjects=None, workdir=None):
+        self.subjects = {} if subjects is None else subjects
+        self.workdir = os.getcwd() if workdir is None else workdir
+
+    @classmethod
+    def build(cls, subjs, workdir=None, jobs=16):
+        """
+        Build a manifest by resolving a list of subjects with `jobs` threads
+        """
+        manifest = cls(workdir=workdir)
+        manifest.update(subjs, jobs)
+        return manifest
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a manifest saved as JSON
+        """
+        with open(filename, 'r') as file:
+            content = json.load(file)
+        return cls(content['subjects'], content['workdir'])
+
+    def save(self, filename):
+        """
+        Save the manifest as JSON, atomically
+        """
+        with open(filename + '.tmp', 'w') as file:
+            json.dump({'workdir': self.workdir, 'subjects': self.subjects}, file, indent=2)
+        os.replace(filename + '.tmp', filename)
+
+    def update(self, subjs, jobs=16):
+        """
+        Resolve (or refresh) the entries of subjects, for example after preprocessing them
+        """
+        subjs = list(subjs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            entries = executor.map(lambda subj: resolve_subject(subj, self.workdir), subjs)
+            self.subjects.update(zip(subjs, entries))
+
+    def __contains__(self, subj):
+        return subj in self.subjects
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def incomplete(self, subj):
+        """
+        Whether a subject is missing from the manifest or has missing files, which might
+        have been created (for example by preprocessing) since it was resolved
+        """
+        entry = self.subjects.get(subj)
+        return entry is None or any(mtime is None for mtime in entry['mtimes'].values())
+
+    def entry(self, subj):
+        """
+        Entry of a subject, which is resolved on demand if it's not in the manifest
+        """
+        entry = self.subjects.get(subj)
+        if entry is None:
+            entry = resolve_subject(subj, self.workdir)
+            self.subjects[subj] = entry
+        return entry
+
+
+def subject_entry(subj, manifest=None, keys=None):
+    """
+    Entry of a subject from an optional manifest, otherwise resolved directly for the
+    given file `keys`
+    """
+    return resolve_subject(subj, keys=keys) if manifest is None else manifest.entry(subj)
+
+
+def load_or_build(filename, subjs, jobs=16):
+    """
+    Load a saved manifest, or build the manifest of `subjs` and save it if the file doesn't
+    exist yet. Subjects of a loaded manifest that are incomplete (missing, or with missing
+    files) are resolved again, and the refreshed manifest is saved. Without a filename,
+    the manifest is only built in memory
+    """
+    if filename is not None and os.path.isfile(filename):
+        manifest = SubjectManifest.load(filename)
+        incomplete = [subj for subj in subjs if manifest.incomplete(subj)]
+        if incomplete:
+            manifest.update(incomplete, jobs)
+            manifest.save(filename)
+        return manifest
+    manifest = SubjectManifest.build(subjs, jobs=jobs)
+    if filename is not None:
+        manifest.save(filename)
+    return manifest
@@ -1,9 +1,11 @@
 import os
+import warnings
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 from . import utils
 from . import ico
@@ -27,6 +29,11 @@ def network_config(name=None):
         'low_res_skip_blocks': [7],
         'include_vertex_properties': True,
         'scale_delta_prediction': 10.,
+        'graph_conv_engine': 'edge',
+        'neighborhood_size': None,
+        'chamfer_memory_budget': None,
+        'checkpoint_orders': [],
+        'precision': 'fp32',
     }
     return config
 
@@ -150,17 +157,33 @@ class ImageUnet(nn.Module):
 
 
 class DynamicGraphConv(torch.nn.Module):
-
-    def __init__(self, in_channels, out_channels, topology, bias=True, activation='leaky'):
+    """
+    Graph convolution over the weighted edges of a mesh topology. The `edge` engine
+    convolves explicitly gathered edge features, while the equivalent `sparse` engine
+    convolves vertex features and aggregates them with a sparse adjacency matrix,
+    avoiding the edge-sized intermediate tensors. With `checkpoint` enabled, intermediate
+    tensors are not stored during training but recomputed in the backward pass.
+    """
+
+    def __init__(self, in_channels, out_channels, topology, bias=True, activation='leaky', engine='edge',
+                 checkpoint=False):
         super().__init__()
 
-        self.in_channels = in_channels
-        self.out_channels = out_channels
+        self.checkpoint = checkpoint
+        # channel counts of decoder convs are numpy integers, which tensor splits reject
+        self.in_channels = int(in_channels)
+        self.out_channels = int(out_channels)
         self.edges_a = topology['adj_edges_a']
         self.edges_b = topology['adj_edges_b']
         self.weights = topology['adj_weights']
         self.size = topology['size']
 
+        if engine == 'sparse':
+            self.adjacency, self.degree = utils.adjacency_matrix(topology)
+        elif engine != 'edge':
+            raise ValueError(f'unknown graph conv engine `{engine}`.')
+        self.engine = engine
+
         if activation == 'leaky':
             self.activation = nn.LeakyReLU(0.3)
         elif activation is None:
@@ -177,25 +200,63 @@ class DynamicGraphConv(torch.nn.Module):
             bias=bias)
 
     def forward(self, input_features):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            # checkpointing only restores CUDA autocast during recomputation, so restore CPU autocast here
+            cpu_autocast = torch.is_autocast_cpu_enabled()
+            cpu_dtype = torch.get_autocast_cpu_dtype()
+            def convolve(features):
+                with torch.autocast('cpu', dtype=cpu_dtype, enabled=cpu_autocast):
+                    return self.convolve(features)
+            return torch.utils.checkpoint.checkpoint(convolve, input_features)
+        return self.convolve(input_features)
+
+    def convolve(self, input_features):
+
+        if self.engine == 'sparse':
+            features = self.sparse_forward(input_features)
+        else:
+            features = self.edge_forward(input_features)
+
+        # activation
+        if self.activation is not None:
+            features = self.activation(features)
+
+        return features
 
-        vertices = input_features[self.edges_a]
-        neighbors = input_features[self.edges_b]
+    def edge_forward(self, input_features):
+
+        vertices = input_features[..., self.edges_a, :]
+        neighbors = input_features[..., self.edges_b, :]
         concat_features = torch.cat([vertices, neighbors - vertices], -1)
 
-        concat_features = torch.unsqueeze(torch.swapaxes(concat_features, -2, -1), 0)
+        # fold any leading batch dimensions into the conv1d batch axis
+        batch_shape = concat_features.shape[:-2]
+        concat_features = concat_features.reshape(-1, *concat_features.shape[-2:])
+        concat_features = torch.swapaxes(concat_features, -2, -1)
         edge_features = self.conv1d(concat_features)
-        edge_features = torch.squeeze(edge_features, 0)
 
         edge_features = torch.swapaxes(edge_features, -2, -1)
-        edge_features_weighted = edge_features * self.weights
-        indices = self.edges_a.unsqueeze(-1).expand(-1, self.out_channels)
-        features = torch.zeros((self.size, self.out_channels), dtype=torch.float32, device=utils.get_device()).scatter_add(-2, indices, edge_features_weighted)
+        edge_features = edge_features.reshape(*batch_shape, *edge_features.shape[-2:])
+        edge_features_weighted = edge_features * self.weights.to(edge_features.dtype)
+        indices = self.edges_a.unsqueeze(-1).expand(edge_features_weighted.shape)
+        features = torch.zeros((*batch_shape, self.size, self.out_channels), dtype=edge_features_weighted.dtype, device=utils.get_device()).scatter_add(-2, indices, edge_features_weighted)
+        return features
 
-        # activation
-        if self.activation is not None:
-            features = self.activation(features)
+    def sparse_forward(self, input_features):
 
-        return features
+        # the 1x1 conv of an edge (a, b) is Wa * x_a + Wd * (x_b - x_a) + bias, so the weighted
+        # sum over the edges of each vertex a is degree_a * ((Wa - Wd) * x_a + bias) + A * (Wd * x)
+        weight_vertex, weight_delta = self.conv1d.weight[..., 0].split(self.in_channels, dim=-1)
+        vertex_features = F.linear(input_features, weight_vertex - weight_delta, self.conv1d.bias)
+        neighbor_features = F.linear(input_features, weight_delta)
+
+        # sparse products don't support reduced precision, so aggregate in the adjacency precision
+        # with autocast disabled (which would otherwise mix precisions in the backward pass), and
+        # return the result in the precision of the activations
+        with torch.autocast(input_features.device.type, enabled=False):
+            aggregated = utils.sparse_aggregate(self.adjacency, neighbor_features.to(self.adjacency.dtype))
+            features = vertex_features.to(self.adjacency.dtype) * self.degree + aggregated
+        return features.to(vertex_features.dtype)
 
 
 class DynamicGraphUnet(torch.nn.Module):
@@ -210,7 +271,9 @@ class DynamicGraphUnet(torch.nn.Module):
                  train_iters=1,
                  infer_iters=1,
                  unet_levels=1,
-                 convs_per_unet_level=4):
+                 convs_per_unet_level=4,
+                 engine='edge',
+                 checkpoint_orders=()):
         super().__init__()
 
         self.order = order
@@ -229,7 +292,8 @@ class DynamicGraphUnet(torch.nn.Module):
             convs = nn.ModuleList()
             for conv in range(convs_per_unet_level):
                 nf = nb_features
-                convs.append(DynamicGraphConv(prev_nf, nf, self.mesh_collection[curr_level]))
+                convs.append(DynamicGraphConv(prev_nf, nf, self.mesh_collection[curr_level], engine=engine,
+                                              checkpoint=curr_level in checkpoint_orders))
                 prev_nf = nf
             self.encoder.append(convs)
             if level < unet_levels - 1:
@@ -245,13 +309,15 @@ class DynamicGraphUnet(torch.nn.Module):
             convs = nn.ModuleList()
             for conv in range(convs_per_unet_level):
                 nf = nb_features
-                convs.append(DynamicGraphConv(prev_nf, nf, self.mesh_collection[curr_level]))
+                convs.append(DynamicGraphConv(prev_nf, nf, self.mesh_collection[curr_level], engine=engine,
+                                              checkpoint=curr_level in checkpoint_orders))
                 prev_nf = nf
             self.decoder.append(convs)
 
         # final conv to estimate mesh deformation
         final_nf = 6 if (self.start_pial or self.input_pial_features) else 3
-        self.finalconv = DynamicGraphConv(prev_nf, final_nf, self.mesh_collection[curr_level], activation=None)
+        self.finalconv = DynamicGraphConv(prev_nf, final_nf, self.mesh_collection[curr_level], activation=None, engine=engine,
+                                          checkpoint=curr_level in checkpoint_orders)
 
     def forward(self, x):
 
@@ -280,10 +346,12 @@ class DynamicGraphUnet(torch.nn.Module):
 
 class SurfNet(nn.Module):
 
-    def __init__(self):
+    def __init__(self, config=None):
         super().__init__()
     
-        self.config = network_config()
+        self.config = network_config() if config is None else config
+        if self.config.get('precision', 'fp32') not in ('fp32', 'bf16'):
+            raise ValueError(f'unknown precision `{self.config["precision"]}`.')
 
         self.image_unet = ImageUnet(self.config['unet_features'])
         self.include_vertex_properties = self.config['include_vertex_properties']
@@ -302,12 +370,18 @@ class SurfNet(nn.Module):
         for n, block in enumerate(config_blocks):
             block['mesh_collection'] = self.mesh_collection
             block['nb_input_features'] = nb_input_features
+            block['engine'] = self.config['graph_conv_engine']
+            block['checkpoint_orders'] = self.config.get('checkpoint_orders', [])
             self.blocks.append(DynamicGraphUnet(**block))
 
         self.low_res_training = False
+        self.low_res_mapping = None
         self.current_neighborhood_target = None
         self.neighborhood = None
 
+        # optional utils.StageTimer to measure the forward pass stages
+        self.timer = None
+
     def initialize_weights(self):
 
         def initialize(m):
@@ -321,28 +395,48 @@ class SurfNet(nn.Module):
         for block in self.blocks:
             torch.nn.init.normal_(block.finalconv.conv1d.weight, mean=0.0, std=1e-4)
 
+    def autocast(self):
+        """
+        Context for running the convolutions in the configured precision. Geometric
+        quantities (coordinates, normals, and losses) are always computed in fp32
+        """
+        enabled = self.config.get('precision', 'fp32') == 'bf16'
+        return torch.autocast(utils.get_device().type, dtype=torch.bfloat16, enabled=enabled)
+
     def forward(self, image, coords):
+        """
+        Predict surface vertices from an image of shape [D, H, W] and initial coordinates
+        of shape [V, 3]. Multiple subjects can be predicted in a single pass by providing
+        a batch of images [B, D, H, W] and coordinates [B, V, 3].
+        """
 
         # 
-        image_shape = list(image.shape)
-        image_shape_tensor = torch.Tensor(image_shape).to(utils.get_device())
+        if image.ndim not in (3, 4):
+            raise ValueError(f'expected 3-dimensional image input (or 4-dimensional batch), but got ndim {image.ndim}')
 
-        # 
-        if len(image_shape) != 3:
-            raise ValueError(f'expected 3-dimensional image input, but got ndim {len(image_shape)}')
+        if coords.ndim != image.ndim - 1:
+            raise ValueError(f'expected {image.ndim - 1}-dimensional input coordinate array, but got ndim {coords.ndim}')
+
+        # add a batch dimension for single-subject inputs
+        batched = image.ndim == 4
+        if not batched:
+            image = image.unsqueeze(0)
+            coords = coords.unsqueeze(0)
+        elif image.shape[0] != coords.shape[0]:
+            raise ValueError(f'image batch size {image.shape[0]} does not match coordinate batch size {coords.shape[0]}')
 
-        if len(coords.shape) != 2:
-            raise ValueError(f'expected 2-dimensional input coordinate array, but got ndim {len(coords.shape)}')
+        # 
+        image_shape = list(image.shape[1:])
+        image_shape_tensor = torch.Tensor(image_shape).to(utils.get_device())
 
-        # predict image-based features
-        image_features = self.image_unet(image.view(1, 1, *image_shape))
+        # predict image-based features, which are sampled at fp32 vertex positions
+        with utils.timed_stage(self.timer, 'image_unet'), self.autocast():
+            image_features = self.image_unet(image.unsqueeze(1))
+        image_features = image_features.float()
 
         # 
         results = {'image_features': image_features}
 
-        # squeeze batch dimension
-        image_features = image_features[0, ...]
-
         previous_order = None
 
         for blockno, block in enumerate(self.blocks):
@@ -356,30 +450,33 @@ class SurfNet(nn.Module):
             # upsample to the next mesh resolution (if necessary)
             if previous_order is not None and previous_order < block.order:
                 indices, weights = topology['upsampler']
-                coords = torch.sum(coords[indices] * weights, -2)
+                coords = torch.sum(coords[..., indices, :] * weights, -2)
 
             # get number of block iterations (usually 1 when training)
             iters = block.train_iters if self.training else block.infer_iters
 
             for it in range(iters):
 
-                # input features
-                input_features = []
+                # sample vertex input features
+                with utils.timed_stage(self.timer, 'vertex_features'):
+                    input_features = []
 
-                # add vertex properties
-                if self.include_vertex_properties:
-                    scaled_coords = coords / torch.max(image_shape_tensor)
-                    normals = utils.compute_normals(coords, topology['faces'])
-                    input_features.extend([scaled_coords, normals])
+                    # add vertex properties
+                    if self.include_vertex_properties:
+                        scaled_coords = coords / torch.max(image_shape_tensor)
+                        normals = utils.compute_normals(coords, topology['faces'])
+                        input_features.extend([scaled_coords, normals])
 
-                # sample image-based features at current white mesh position
-                input_features.append(utils.point_sample(coords, image_features, image_shape_tensor))
+                    # sample image-based features at current white mesh position
+                    input_features.append(utils.point_sample(coords, image_features, image_shape_tensor))
                 
-                # concatenate input features
-                sampled_features = torch.cat(input_features, axis=-1) if len(input_features) > 1 else input_features[0]
+                    # concatenate input features
+                    sampled_features = torch.cat(input_features, axis=-1) if len(input_features) > 1 else input_features[0]
 
                 # predict and apply the deformation in mesh space
-                deformation = block(sampled_features)
+                with utils.timed_stage(self.timer, f'graph_unet_{blockno}_order_{block.order}'), self.autocast():
+                    deformation = block(sampled_features)
+                deformation = deformation.float()
 
                 if self.scale_delta_prediction is not None:
                     deformation = deformation * self.scale_delta_prediction
@@ -387,41 +484,66 @@ class SurfNet(nn.Module):
                 coords = coords + deformation
                 previous_order = block.order
 
-        results['pred_vertices'] = coords
+        results['pred_vertices'] = coords if batched else coords[0]
         return (results, topology)
 
-    def guided_chamfer_loss(self, y_true, y_pred):
+    def target_vertices(self, true_vertices):
+        """
+        Return the subset of full-resolution (ico-7) true vertices [..., V, 3] that
+        matches the predicted mesh, which is ico-6 during low-res training
+        """
+        if not self.low_res_training:
+            return true_vertices
+        if self.low_res_mapping is None:
+            mapping = ico.get_mapping(7, 6)
+            self.low_res_mapping = torch.from_numpy(mapping).to(true_vertices.device).long()
+        return true_vertices[..., self.low_res_mapping, :]
+
+    def guided_chamfer_loss(self, y_true, y_pred, reduction='mean'):
+        """
+        Symmetric chamfer distance between true and predicted vertices [..., V, 3], with nearest
+        neighbors searched within the icosphere neighborhood of each vertex. Batched inputs are
+        reduced per sample, and `reduction='none'` returns the per-sample losses
+        """
 
         order = 6 if self.low_res_training else 7
         if self.current_neighborhood_target != order:
             if self.neighborhood is not None:
                 del self.neighborhood
-            self.neighborhood = torch.from_numpy(ico.neighborhood(order)).to(utils.get_device())
+            # upload the compact (memory-mapped) int32 neighborhood and widen it on the device
+            neighborhood = ico.neighborhood(order, self.config.get('neighborhood_size'))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                self.neighborhood = torch.from_numpy(neighborhood).to(utils.get_device()).long()
             self.current_neighborhood_target = order
 
-        y_pred_gathered = y_pred[self.neighborhood]                               # [vert, neighbors, 3]
-        y_true_ext = torch.unsqueeze(y_true, dim=-2)                              # [vert, 1, 3]
-        a_sqr_distances = torch.sum((y_true_ext - y_pred_gathered) ** 2, dim=-1)  # [vert, neighbors]
-        a_min_dist, _ = torch.min(torch.sqrt(a_sqr_distances), dim=-1)            # [neighbors]
+        # find the nearest neighbors without tracking gradients, processing vertex chunks
+        # that fit in the memory budget, then only compute the selected distances with
+        # gradients - this matches the gradient of taking the min over all neighbor distances
+        budget = self.config.get('chamfer_memory_budget')
+        a_nearest = utils.nearest_neighbors(y_true, y_pred, self.neighborhood, budget)  # [..., vert]
+        b_nearest = utils.nearest_neighbors(y_pred, y_true, self.neighborhood, budget)  # [..., vert]
 
-        y_true_gathered = y_true[self.neighborhood]                               # [vert, neighbors, 3]
-        y_pred_ext = torch.unsqueeze(y_pred, dim=-2)                              # [vert, 1, 3]
-        b_sqr_distances = torch.sum((y_pred_ext - y_true_gathered) ** 2, dim=-1)  # [vert, neighbors]
-        b_min_dist, _ = torch.min(torch.sqrt(b_sqr_distances), dim=-1)            # [neighbors]
+        a_min_dist = torch.norm(y_true - utils.gather_vertices(y_pred, a_nearest), dim=-1)  # [..., vert]
+        b_min_dist = torch.norm(y_pred - utils.gather_vertices(y_true, b_nearest), dim=-1)  # [..., vert]
 
-        loss = torch.mean(torch.cat([a_min_dist, b_min_dist]))
-        return loss
+        loss = torch.mean(torch.cat([a_min_dist, b_min_dist], dim=-1), dim=-1)             # [...]
+        return utils.reduce_loss(loss, reduction)
 
-    def hinge_spring_loss(self, y_pred, topology):
-        face_vertices = y_pred[topology['faces']]                                        # [faces, 3, 3]
-        face_norms = utils.face_normals(face_vertices, clockwise=False, normalize=True)  # [faces, 3]
-        edge_face_normals = face_norms[topology['edge_faces']]                           # [edges, 2, 3]
+    def hinge_spring_loss(self, y_pred, topology, reduction='mean'):
+        """
+        Penalize the angle between the normals of adjacent faces of predicted vertices
+        [..., V, 3]. Batched inputs are reduced like `guided_chamfer_loss`
+        """
+        face_vertices = y_pred[..., topology['faces'], :]                                # [..., faces, 3, 3]
+        face_norms = utils.face_normals(face_vertices, clockwise=False, normalize=True)  # [..., faces, 3]
+        edge_face_normals = face_norms[..., topology['edge_faces'], :]                   # [..., edges, 2, 3]
 
-        norm_a = edge_face_normals[:, 0, :]                                              # [edges, 3]
-        norm_b = edge_face_normals[:, 1, :]                                              # [edges, 3]
+        norm_a = edge_face_normals[..., 0, :]                                            # [..., edges, 3]
+        norm_b = edge_face_normals[..., 1, :]                                            # [..., edges, 3]
 
-        dot = torch.sum(torch.multiply(norm_a, norm_b), dim=-1)                          # [edges]
+        dot = torch.sum(torch.multiply(norm_a, norm_b), dim=-1)                          # [..., edges]
         error = (1 - dot) ** 2
 
-        loss = torch.mean(error, dim=-1)                                                 # [1]
-        return loss
+        loss = torch.mean(error, dim=-1)                                                 # [...]
+        return utils.reduce_loss(loss, reduction)
@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import tempfile
+import functools
+import subprocess
+import concurrent.futures
+import numpy as np
+import surfa as sf
+
+from . import io
+from . import manifest
+
+
+def fsaverage_path(subj, avg=None):
+    """
+    Path to the fsaverage subject used as the resampling target. Unless provided, fsaverage
+    is expected next to the subject and otherwise taken from the FreeSurfer installation
+    """
+    if avg is not None:
+        return avg
+    linked = os.path.join(os.path.dirname(subj.rstrip('/')), 'fsaverage')
+    if os.path.exists(linked):
+        return linked
+    if os.environ.get('FREESURFER_HOME') is None:
+        raise RuntimeError(f'cannot find fsaverage next to {subj} and FREESURFER_HOME is not set')
+    return os.path.join(os.environ['FREESURFER_HOME'], 'subjects', 'fsaverage')
+
+
+def output_paths(subj, rod=False):
+    """
+    Paths of the talairach LTA and the ico-resampled white surfaces of a subject. With
+    `rod` (read-only data), outputs are written to the ltafiles and whiteicosurf
+    directories of the current working directory
+    """
+    if rod:
+        id = manifest.subject_id(subj)
+        cwd = os.getcwd()
+        return {
+            'lta': f'{cwd}/ltafiles/{id}.talairach.xfm.lta',
+            'lh': f'{cwd}/whiteicosurf/{id}.lh.white.ico.surf',
+            'rh': f'{cwd}/whiteicosurf/{id}.rh.white.ico.surf',
+        }
+    return {
+        'lta': f'{subj}/mri/transforms/talairach.xfm.lta',
+        'lh': f'{subj}/surf/lh.white.ico.surf',
+        'rh': f'{subj}/surf/rh.white.ico.surf',
+    }
+
+
+def is_up_to_date(output_mtime, input_mtimes):
+    """
+    Check whether an output exists and is newer than all of its (existing) inputs, given
+    their modification times (None for missing files)
+    """
+    if output_mtime is None:
+        return False
+    return all(mtime <= output_mtime for mtime in input_mtimes if mtime is not None)
+
+
+def run_command(cmd, retries=0):
+    """
+    Run a shell command, retrying on failure. Absolute subject paths are supported by
+    setting SUBJECTS_DIR to the root directory. Raises a RuntimeError with the command
+    output if all attempts fail
+    """
+    env = dict(os.environ, SUBJECTS_DIR='/')
+    for attempt in range(retries + 1):
+        result = subprocess.run(cmd, shell=True, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode == 0:
+            return
+    raise RuntimeError(f'command failed with exit code {result.returncode}: {cmd}\n{result.stdout[-2000:]}')
+
+
+def convert_lta(subj, output, avg, retries=0):
+    """
+    Convert the talairach.xfm of a subject into a vox2vox LTA with lta_convert
+    """
+    fshome = os.environ['FREESURFER_HOME']
+    cmd = f'lta_convert --src {subj}/mri/orig.mgz ' \
+          f'--trg {fshome}/average/mni305.cor.mgz --inxfm {subj}/mri/transforms/talairach.xfm ' \
+          f'--outlta {output} --subject {avg} --ltavox2vox'
+    run_command(cmd, retries)
+
+
+def resample_surface(subj, hemi, output, avg, retries=0):
+    """
+    Resample the white surface of a subject onto the fsaverage ico-7 topology with mri_surf2surf
+    """
+    cmd = f'mri_surf2surf --mapmethod nnf --s {subj} --hemi {hemi} --sval-xyz white ' \
+          f'--trgsubject {avg} --tval {output} ' \
+          f'--tval-xyz {subj}/mri/norm.mgz'
+    run_command(cmd, retries)
+
+
+def convert_lta_native(subj, output, avg=None):
+    """
+    Convert the talairach.xfm of a subject into a vox2vox LTA without FreeSurfer
+    """
+    io.talairach_xfm_to_lta(subj, output)
+
+
+def resample_surface_native(subj, hemi, output, avg):
+    """
+    Resample the white surface of a subject onto the fsaverage ico-7 topology without
+    FreeSurfer. Like `mri_surf2surf --mapmethod nnf`, each fsaverage vertex takes the
+    position of the nearest subject vertex on the registered spheres
+    """
+    from scipy.spatial import cKDTree
+
+    source_sphere = sf.load_mesh(f'{subj}/surf/{hemi}.sphere.reg').vertices
+    target_sphere = sf.load_mesh(f'{avg}/surf/{hemi}.sphere.reg')
+    white = sf.load_mesh(f'{subj}/surf/{hemi}.white')
+
+    # search on the unit sphere so that differences in sphere radius don't matter
+    source_sphere = source_sphere / np.linalg.norm(source_sphere, axis=-1, keepdims=True)
+    target_points = target_sphere.vertices / np.linalg.norm(target_sphere.vertices, axis=-1, keepdims=True)
+    _, nearest = cKDTree(source_sphere).query(target_points, workers=-1)
+
+    geometry = io.load_image_geometry(f'{subj}/mri/norm.mgz')
+    surf = sf.Mesh(white.vertices[nearest], target_sphere.faces, space='surf', geometry=geometry)
+    surf.save(output)
+
+
+def verify_native_surface(subj, hemi, avg=None):
+    """
+    Compare the native surface resampling of a subject against mri_surf2surf, returning the
+    fraction of identical vertices and the maximum vertex distance
+    """
+    avg = fsaverage_path(subj, avg)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        reference = os.path.join(tmpdir, f'{hemi}.reference.surf')
+        native = os.path.join(tmpdir, f'{hemi}.native.surf')
+        resample_surface(subj, hemi, reference, avg)
+        resample_surface_native(subj, hemi, native, avg)
+        reference = sf.load_mesh(reference).vertices
+        native = sf.load_mesh(native).vertices
+    dist = np.linalg.norm(native - reference, axis=-1)
+    return np.mean(dist < 1e-4), dist.max()
+
+
+def verify_native_lta(subj, avg=None):
+    """
+    Compare the native talairach LTA conversion of a subject against lta_convert,
+    returning the maximum absolute difference of the vox2vox matrices
+    """
+    avg = fsaverage_path(subj, avg)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, 'talairach.xfm.lta')
+        convert_lta(subj, output, avg)
+        reference = sf.load_affine(output)
+    native = io.talairach_xfm_to_lta(subj)
+    return np.abs(native.matrix - reference.matrix).max()
+
+
+def preprocess_subject(subj, avg=None, rod=False, retries=0, force=False, native=False, entry=None):
+    """
+    Preprocess a subject, skipping outputs that are newer than their inputs. The hemispheres
+    are resampled concurrently. With `native` enabled, the talairach LTA conversion and
+    surface resampling run in python instead of FreeSurfer, and `retries` only applies to
+    FreeSurfer commands. Outputs are written to a temporary file that replaces the output
+    once a step succeeds, so interrupted steps never leave outputs that look up to date.
+    Modification times are taken from a subject manifest `entry` if provided. Returns a
+    status dictionary with the state of each step (`done`, `skipped`, or `failed`) and
+    the overall subject status
+    """
+    start = time.perf_counter()
+    avg = fsaverage_path(subj, avg)
+    outputs = output_paths(subj, rod)
+    status = {'status': 'done', 'steps': {}, 'errors': {}}
+    if entry is None:
+        entry = manifest.resolve_subject(subj)
+
+    def mtime(key, path=None):
+        # the manifest might have resolved an output to the other subject layout
+        if path is None or entry['paths'][key] == path:
+            return entry['mtimes'][key]
+        return os.path.getmtime(path) if os.path.isfile(path) else None
+
+    # manifest keys of the step outputs
+    output_keys = {'lta': 'lta', 'lh': 'lh.white.ico', 'rh': 'rh.white.ico'}
+
+    def step(name, output, inputs, func, *args):
+        if not force and is_up_to_date(mtime(output_keys[name], output), [mtime(key) for key in inputs]):
+            status['steps'][name] = 'skipped'
+            return
+        # keep the output name at the end, so that its format is detected from the extension
+        dirname, basename = os.path.split(output)
+        tmp = os.path.join(dirname, f'.tmp-{os.getpid()}-{basename}')
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            func(*args, tmp, avg)
+            os.replace(tmp, output)
+            status['steps'][name] = 'done'
+        except Exception as error:
+            status['steps'][name] = 'failed'
+            status['errors'][name] = str(error)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    # talairach LTA
+    func = convert_lta_native if native else functools.partial(convert_lta, retries=retries)
+    step('lta', outputs['lta'], ['orig', 'xfm'], func, subj)
+
+    # resample both hemispheres at the same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        for hemi in ('lh', 'rh'):
+            surf_inputs = [f'{hemi}.white', f'{hemi}.sphere.reg', 'norm']
+            func = resample_surface_native if native else functools.partial(resample_surface, retries=retries)
+            executor.submit(step, hemi, outputs[hemi], surf_inputs, func, subj, hemi)
+
+    steps = status['steps'].values()
+    if 'failed' in steps:
+        status['status'] = 'failed'
+    elif all(s == 'skipped' for s in steps):
+        status['status'] = 'skipped'
+    status['seconds'] = time.perf_counter() - start
+    return status
+
+
+class Manifest:
+    """
+    JSON record of the preprocessing status of each subject, rewritten atomically
+    whenever a subject is updated
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.subjects = {}
+        if os.path.isfile(filename):
+            with open(filename, 'r') as file:
+                self.subjects = json.load(file)
+
+    def update(self, subj, status):
+        self.subjects[subj] = dict(status, time=time.strftime('%Y-%m-%d %H:%M:%S'))
+        with open(self.filename + '.tmp', 'w') as file:
+            json.dump(self.subjects, file, indent=2)
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+def preprocess_subjects(subjs, jobs=1, avg=None, rod=False, retries=0, force=False, native=False, manifest=None,
+                        subject_manifest=None):
+    """
+    Preprocess subjects in a pool of `jobs` processes, yielding (subject, status) pairs as
+    subjects complete. Failures are isolated to their subject, and statuses are recorded
+    in an optional `Manifest`. Modification times are taken from an optional
+    `SubjectManifest`, whose entries are refreshed as subjects complete
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for subj in subjs:
+            entry = None if subject_manifest is None else subject_manifest.entry(subj)
+            futures[executor.submit(preprocess_subject, subj, avg, rod, retries, force, native, entry)] = subj
+        for future in concurrent.futures.as_completed(futures):
+            subj = futures[future]
+            try:
+                status = future.result()
+            except Exception as error:
+                status = {'status': 'failed', 'steps': {}, 'errors': {'subject': str(error)}}
+            if manifest is not None:
+                manifest.update(subj, status)
+            if subject_manifest is not None:
+                subject_manifest.update([subj])
+            yield subj, status
@@ -0,0 +1,222 @@
+import os
+import glob
+import json
+import stat
+import time
+import socket
+import threading
+import socketserver
+
+from . import io
+from . import inference
+
+
+class InferenceServer:
+    """
+    Keeps TopoFit models resident in memory and runs subject jobs against them.
+    A job is a dictionary with the following keys:
+
+        subj:   path to the recon subject (required)
+        hemi:   `lh`, `rh`, or `both` (default is `both`)
+        models: optional mapping of hemisphere to model checkpoint, overriding
+                the server defaults
+        suffix: output surface suffix (default is `topofit`)
+        outdir: optional output directory for surfaces
+    """
+
+    def __init__(self, default_models=None):
+        self.default_models = dict(default_models or {})
+        self.models = {}
+        self.lock = threading.Lock()
+        for filename in self.default_models.values():
+            self.get_model(filename)
+
+    def get_model(self, filename):
+        """
+        Return a resident model, loading the checkpoint on first use
+        """
+        filename = os.path.abspath(filename)
+        model = self.models.get(filename)
+        if model is None:
+            model = inference.load_model(filename)
+            self.models[filename] = model
+        return model
+
+    def run_job(self, job):
+        """
+        Run a single subject job, yielding an event dictionary for each written
+        surface and a final event with the job status and timings
+        """
+        start_time = time.perf_counter()
+        subj = None
+        timings = {}
+
+        try:
+            if not isinstance(job, dict):
+                raise ValueError(f'job must be a dictionary, but got {type(job).__name__}')
+            subj = job.get('subj')
+            hemi = job.get('hemi', 'both')
+            hemis = ('lh', 'rh') if hemi == 'both' else (hemi,)
+            if subj is None:
+                raise ValueError('job does not specify a subject')
+            if any(h not in ('lh', 'rh') for h in hemis):
+                raise ValueError(f"hemi must be 'lh', 'rh', or 'both', but got `{hemi}`")
+
+            model_files = {**self.default_models, **job.get('models', {})}
+            missing = [h for h in hemis if h not in model_files]
+            if missing:
+                raise ValueError(f'no model available for hemi(s) {", ".join(missing)}')
+
+            # the lock serializes jobs across client connections
+            with self.lock:
+                step_time = time.perf_counter()
+                hemi_data = io.load_subject_hemis(subj, hemis)
+                timings['load'] = time.perf_counter() - step_time
+
+                for h in hemis:
+                    step_time = time.perf_counter()
+                    model = self.get_model(model_files[h])
+                    vertices, faces = inference.predict_vertices(model, [hemi_data[h]])
+                    timings[f'{h}-predict'] = time.perf_counter() - step_time
+
+                    step_time = time.perf_counter()
+                    surf = inference.build_surface(vertices[0], faces, hemi_data[h])
+                    filename = inference.surface_filename(subj, h, job.get('suffix', 'topofit'), job.get('outdir'))
+                    surf.save(filename)
+                    timings[f'{h}-write'] = time.perf_counter() - step_time
+
+                    yield {'subj': subj, 'hemi': h, 'status': 'saved', 'filename': filename}
+
+        except Exception as error:
+            timings['total'] = time.perf_counter() - start_time
+            yield {'subj': subj, 'status': 'failed', 'error': f'{type(error).__name__}: {error}', 'timings': timings}
+            return
+
+        timings['total'] = time.perf_counter() - start_time
+        yield {'subj': subj, 'status': 'done', 'timings': timings}
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads line-separated JSON jobs from a client and streams back one JSON event per line
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as error:
+                self.send({'status': 'failed', 'error': f'invalid job: {error}'})
+                continue
+            for event in self.server.inference_server.run_job(job):
+                self.send(event)
+
+    def send(self, event):
+        self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+
+class UnixJobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def remove_stale_socket(path):
+    """
+    Remove a leftover UNIX socket at `path` that no server is listening on anymore. Raises
+    FileExistsError if a server still answers on it or if the path isn't a socket
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f'{path} exists and is not a socket')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # nobody is listening, so the socket was left behind by a dead server
+            pass
+        else:
+            raise FileExistsError(f'a server is already listening on {path}')
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def serve_socket(inference_server, path):
+    """
+    Accept jobs over a UNIX socket until interrupted. A stale socket left at `path` is
+    replaced, but a socket of a running server is never taken over
+    """
+    remove_stale_socket(path)
+    with UnixJobServer(path, JobRequestHandler) as server:
+        os.chmod(path, 0o600)
+        server.inference_server = inference_server
+        print(f'Listening for jobs on {path}', flush=True)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+
+def spooled_jobfiles(spooldir):
+    """
+    Job files of a spool directory, oldest first. Files that disappear while listing
+    them (claimed by another server) are skipped
+    """
+    jobfiles = []
+    for jobfile in glob.glob(os.path.join(spooldir, '*.json')):
+        try:
+            jobfiles.append((os.path.getmtime(jobfile), jobfile))
+        except FileNotFoundError:
+            continue
+    return [jobfile for _, jobfile in sorted(jobfiles)]
+
+
+def serve_spool(inference_server, spooldir, poll_interval=1.0):
+    """
+    Run jobs dropped into a spool directory until interrupted. Each `*.json` job file
+    is claimed by renaming it, events are streamed to a matching `*.events.jsonl` file,
+    and the job file is finally renamed with a `.done` or `.failed` extension
+    """
+    os.makedirs(spooldir, exist_ok=True)
+    print(f'Watching for jobs in {spooldir}', flush=True)
+    while True:
+        jobfiles = spooled_jobfiles(spooldir)
+        if not jobfiles:
+            time.sleep(poll_interval)
+            continue
+
+        jobfile = jobfiles[0]
+        basename = jobfile[:-len('.json')]
+        running = basename + '.running'
+        try:
+            os.rename(jobfile, running)
+        except FileNotFoundError:
+            # claimed by another server watching the same directory
+            continue
+
+        status = 'done'
+        with open(basename + '.events.jsonl', 'w') as events:
+            try:
+                with open(running, 'r') as file:
+                    jobs = json.load(file)
+                for job in (jobs if isinstance(jobs, list) else [jobs]):
+                    for event in inference_server.run_job(job):
+                        events.write(json.dumps(event) + '\n')
+                        events.flush()
+                        if event['status'] == 'failed':
+                            status = 'failed'
+            except json.JSONDecodeError as error:
+                events.write(json.dumps({'status': 'failed', 'error': f'invalid job: {error}'}) + '\n')
+                status = 'failed'
+            except Exception as error:
+                # keep serving, so that a bad job file can't take down the server
+                events.write(json.dumps({'status': 'failed', 'error': f'{type(error).__name__}: {error}'}) + '\n')
+                status = 'failed'
+        os.rename(running, f'{basename}.{status}')
+
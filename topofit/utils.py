@@ -1,5 +1,7 @@
+import time
+import contextlib
 import torch
-from torch_scatter import scatter_max
+import torch.profiler
 
 
 #  a way to track the current torch device globally
@@ -36,6 +38,58 @@ def read_file_list(filename, prefix=None, suffix=None):
     return filelist
 
 
+class StageTimer:
+    """
+    Accumulate the time spent in named stages, which are labeled in torch profiler traces.
+    On CUDA, stage boundaries are recorded as events on the device stream, so timing never
+    blocks the host or serializes queued device work, and the elapsed device times are
+    collected when the times are reset. On CPU, the wall time of each stage is measured
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.pending = []
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        device = get_device()
+        if device is not None and device.type == 'cuda':
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            with torch.profiler.record_function(name):
+                yield
+            end.record()
+            self.pending.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            with torch.profiler.record_function(name):
+                yield
+            self.add(name, time.perf_counter() - start)
+
+    def reset(self):
+        """
+        Return the accumulated stage times (in seconds) and start over
+        """
+        for name, start, end in self.pending:
+            end.synchronize()
+            self.add(name, start.elapsed_time(end) / 1000)
+        self.pending = []
+        times = self.times
+        self.times = {}
+        return times
+
+
+def timed_stage(timer, name):
+    """
+    Time a stage with an optional `StageTimer`
+    """
+    return contextlib.nullcontext() if timer is None else timer.stage(name)
+
+
 def cross(vector1, vector2, dim=-1):
     """
     Cross product of two Nx3 vector arrays
@@ -50,14 +104,21 @@ def cross(vector1, vector2, dim=-1):
 
 def point_sample(coords, features, image_size, normed=False):
     """
-    Sample image features from a set of coordinates
+    Sample image features from a set of coordinates. Coordinates of shape [B, V, 3]
+    sample from a batch of features of shape [B, C, D, H, W]
     """
     if not normed:
         half_size = (image_size - 1) / 2
         coords = (coords - half_size) / half_size
-    coords = torch.reshape(coords, (1, coords.shape[-2], 1, 1, coords.shape[-1]))
-    point_features = torch.nn.functional.grid_sample(features.unsqueeze(0).swapaxes(-1, -3), coords, align_corners=True, mode='bilinear')
-    point_features = point_features.squeeze(0).squeeze(-1).squeeze(-1).swapaxes(-1, -2)
+    batched = coords.ndim == 3
+    if not batched:
+        coords = coords.unsqueeze(0)
+        features = features.unsqueeze(0)
+    coords = torch.reshape(coords, (coords.shape[0], coords.shape[-2], 1, 1, coords.shape[-1]))
+    point_features = torch.nn.functional.grid_sample(features.swapaxes(-1, -3), coords, align_corners=True, mode='bilinear')
+    point_features = point_features.squeeze(-1).squeeze(-1).swapaxes(-1, -2)
+    if not batched:
+        point_features = point_features.squeeze(0)
     return point_features
 
 
@@ -78,25 +139,100 @@ def compute_normals(coords, face_indices):
     """
     Compute vertex normals as an averge of face normals
     """
-    face_coords = coords[face_indices]
+    face_coords = coords[..., face_indices, :]
     mesh_face_normals = face_normals(face_coords, clockwise=False, normalize=False)
 
-    unnorm_vertex_normals = torch.zeros(coords.shape, dtype=torch.float32, device=get_device())
+    unnorm_vertex_normals = torch.zeros(coords.shape, dtype=coords.dtype, device=get_device())
     for i in range(3):
-        unnorm_vertex_normals = unnorm_vertex_normals.scatter_add(-2, face_indices[..., i:i + 1].expand(-1, 3), mesh_face_normals)
+        indices = face_indices[..., i:i + 1].expand(mesh_face_normals.shape)
+        unnorm_vertex_normals = unnorm_vertex_normals.scatter_add(-2, indices, mesh_face_normals)
 
     vector_norms = torch.sqrt(torch.sum(unnorm_vertex_normals ** 2, dim=-1, keepdims=True))
     return unnorm_vertex_normals / vector_norms
 
 
+def adjacency_matrix(topology):
+    """
+    Weighted sparse adjacency matrix of a mesh topology and its row sums (the
+    weighted vertex degrees). Both are cached in the topology dictionary
+    """
+    if topology.get('adj_matrix') is None:
+        size = topology['size']
+        edges_a = topology['adj_edges_a']
+        weights = topology['adj_weights'][:, 0]
+        indices = torch.stack([edges_a, topology['adj_edges_b']])
+        topology['adj_matrix'] = torch.sparse_coo_tensor(indices, weights, (size, size)).coalesce()
+        degree = torch.zeros(size, dtype=weights.dtype, device=weights.device).scatter_add(0, edges_a, weights)
+        topology['adj_degree'] = degree.unsqueeze(-1)
+    return topology['adj_matrix'], topology['adj_degree']
+
+
+def sparse_aggregate(matrix, features):
+    """
+    Multiply a sparse [V, V] matrix with vertex features of shape [..., V, C]
+    """
+    batch_shape = features.shape[:-2]
+    nb_vertices, nb_features = features.shape[-2:]
+    features = features.movedim(-2, 0).reshape(nb_vertices, -1)
+    aggregated = torch.sparse.mm(matrix, features)
+    return aggregated.reshape(matrix.shape[0], *batch_shape, nb_features).movedim(0, -2)
+
+
+def nearest_neighbors(source, target, neighborhood, memory_budget=None):
+    """
+    For each source vertex, find the index of the nearest target vertex among its neighborhood
+    (of shape [V, K]). Squared distances are computed in chunks of vertices so that temporary
+    buffers stay within `memory_budget` bytes. Gradients are not tracked
+    """
+    nb_vertices, nb_neighbors = neighborhood.shape
+    batch_shape = source.shape[:-2]
+
+    # per neighbor, the gathered candidate coordinates (which are squared differences in
+    # place) and the squared distance of each batch entry
+    bytes_per_vertex = batch_shape.numel() * nb_neighbors * 4 * source.element_size()
+    chunk_size = nb_vertices if memory_budget is None else max(int(memory_budget // bytes_per_vertex), 1)
+
+    nearest = torch.empty((*batch_shape, nb_vertices), dtype=torch.int64, device=source.device)
+    with torch.no_grad():
+        for start in range(0, nb_vertices, chunk_size):
+            indices = neighborhood[start:start + chunk_size]                             # [chunk, neighbors]
+            candidates = target[..., indices, :]                                         # [..., chunk, neighbors, 3]
+            points = source[..., start:start + chunk_size, :].unsqueeze(-2)              # [..., chunk, 1, 3]
+            sqr_distances = candidates.sub_(points).square_().sum(dim=-1)                # [..., chunk, neighbors]
+            closest = torch.argmin(sqr_distances, dim=-1, keepdim=True)                  # [..., chunk, 1]
+            indices = indices.expand(*closest.shape[:-1], nb_neighbors)
+            nearest[..., start:start + chunk_size] = torch.gather(indices, -1, closest).squeeze(-1)
+
+            # release the buffers before the next chunk allocates its own
+            del candidates, sqr_distances
+    return nearest
+
+
+def gather_vertices(coords, indices):
+    """
+    Gather vertex coordinates [..., V, 3] with per-vertex indices [..., N]
+    """
+    return torch.gather(coords, -2, indices.unsqueeze(-1).expand(*indices.shape, coords.shape[-1]))
+
+
+def reduce_loss(loss, reduction='mean'):
+    """
+    Reduce per-sample losses, either to their `mean` or not at all (`none`)
+    """
+    if reduction == 'mean':
+        return torch.mean(loss)
+    elif reduction == 'none':
+        return loss
+    raise ValueError(f'unknown loss reduction `{reduction}`.')
+
+
 def pool(features, mesh_info):
     """
     Pooling of an icosphere order
     """
     pooled = gather_vertex_features(features,
-        mesh_info['pooling_shape_a'],
-        mesh_info['pooling_b'],
-        mesh_info['pooling_a'],)
+        mesh_info['pooling_table_a'],
+        mesh_info['pooling_empty_a'])
     return pooled
 
 
@@ -105,18 +241,20 @@ def unpool(features, mesh_info):
     Unpooling of an icosphere order
     """
     unpooled = gather_vertex_features(features,
-        mesh_info['pooling_shape_b'],
-        mesh_info['pooling_a'],
-        mesh_info['pooling_b'],)
+        mesh_info['pooling_table_b'],
+        mesh_info['pooling_empty_b'])
     return unpooled
 
 
-def gather_vertex_features(features, size, sources, targets):
+def gather_vertex_features(features, table, empty=None):
     """
-    Gather vertex features across any array
+    Gather the maximum vertex features across a fixed fan-in table of sources for
+    each target vertex, floored at -1000. Targets without sources (flagged by `empty`)
+    are set to -1000
     """
-    nb_features = features.shape[-1]
-    gathered_features = features[sources]
-    out = torch.zeros((size, nb_features), dtype=torch.float32, device=get_device()) - 1000
-    out, _ = scatter_max(gathered_features, targets, -2, out=out)
+    gathered_features = features[..., table, :]
+    out, _ = torch.max(gathered_features, dim=-2)
+    out = out.clamp(min=-1000)
+    if empty is not None:
+        out = out.masked_fill(empty.unsqueeze(-1), -1000)
     return out